@@ -5,15 +5,32 @@ Core logic for bidirectional synchronization.
 Supports: Dia, Vivaldi, Microsoft Edge, Arc Browser.
 """
 
+import functools
+import os
 import sqlite3
+from collections import deque
+from contextlib import closing
 import shutil
 import json
 import logging
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
+from urllib.parse import quote
 import subprocess
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configuração de Logs
 logging.basicConfig(
     level=logging.INFO,
@@ -22,6 +39,143 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1)
+def _running_procs() -> frozenset:
+    """Lista os processos ativos UMA vez por execução.
+
+    Com psutil a leitura é in-process (sysctl no macOS, /proc no Linux),
+    zero forks; sem psutil cai no fork único de `ps`.
+    """
+    if psutil is not None:
+        return frozenset(p.info['name'] for p in psutil.process_iter(['name']) if p.info['name'])
+    out = subprocess.run(["ps", "-Axco", "comm"], capture_output=True, text=True)
+    if out.returncode != 0 or not out.stdout.strip():
+        # `ps` do Linux (procps) não aceita -Axco; forma portátil equivalente.
+        out = subprocess.run(["ps", "-A", "-o", "comm="], capture_output=True, text=True)
+    return frozenset(Path(line.strip()).name for line in out.stdout.splitlines() if line.strip())
+
+def _fast_copy(src: Path, dst: Path):
+    """Copia um arquivo com o mínimo de syscalls.
+
+    Linux: os.copy_file_range (cópia dentro do kernel, zero-copy).
+    macOS: shutil.copyfile já usa fcopyfile(3). Sem copy2 — a cópia é
+    temporária, não precisamos preservar metadados.
+    """
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dst)
+        return
+    with open(src, 'rb') as fs, open(dst, 'wb') as fd:
+        try:
+            while os.copy_file_range(fs.fileno(), fd.fileno(), 1 << 30):
+                pass
+        except OSError:
+            # Filesystems sem suporte (EXDEV etc): buffer de 1MB.
+            shutil.copyfileobj(fs, fd, length=1 << 20)
+
+# Cache de stat por execução: exists()/is_dir()/stat() repetidos sobre os
+# mesmos caminhos de perfil (History, Bookmarks, Sessions) viram 1 syscall.
+_stat_cache = {}
+
+def _cached_stat(path: Path):
+    """os.stat memoizado; devolve None se o caminho não existe."""
+    key = str(path)
+    if key not in _stat_cache:
+        try:
+            _stat_cache[key] = os.stat(path)
+        except OSError:
+            _stat_cache[key] = None
+    return _stat_cache[key]
+
+def _cached_exists(path: Path) -> bool:
+    return _cached_stat(path) is not None
+
+def _invalidate_stat_cache():
+    _stat_cache.clear()
+
+def _dir_fingerprint(d: Path):
+    """Impressão digital barata do conteúdo: (caminho, tamanho, mtime_ns) por arquivo."""
+    entries = []
+    stack = [d]
+    while stack:
+        cur = stack.pop()
+        with os.scandir(cur) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append((os.path.relpath(entry.path, d), st.st_size, st.st_mtime_ns))
+    entries.sort()
+    return entries
+
+def _rsync_dir(src: Path, dst: Path):
+    """Espelha dst a partir de src copiando só o que mudou (estilo rsync).
+
+    Usa os.scandir para aproveitar o stat que o kernel já devolve com a
+    entrada de diretório; arquivos com mesmo tamanho e mtime são pulados,
+    e entradas que sumiram da origem são removidas do destino.
+    """
+    # Conflito de tipo em qualquer nível: se o destino é um arquivo (ou
+    # symlink) onde a origem tem um diretório, remove antes de criar.
+    if os.path.lexists(dst) and not os.path.isdir(dst):
+        os.unlink(dst)
+    os.makedirs(dst, exist_ok=True)
+    src_names = set()
+    with os.scandir(src) as it:
+        for entry in it:
+            src_names.add(entry.name)
+            d_path = dst / entry.name
+            if entry.is_dir(follow_symlinks=False):
+                _rsync_dir(Path(entry.path), d_path)
+                continue
+            s_stat = entry.stat(follow_symlinks=False)
+            try:
+                d_stat = os.stat(d_path)
+                if d_stat.st_size == s_stat.st_size and d_stat.st_mtime_ns == s_stat.st_mtime_ns:
+                    continue
+                if not os.path.isfile(d_path):
+                    shutil.rmtree(d_path)
+            except FileNotFoundError:
+                pass
+            _fast_copy(Path(entry.path), d_path)
+            # Preserva o mtime para que o skip funcione na próxima execução.
+            os.utime(d_path, ns=(s_stat.st_atime_ns, s_stat.st_mtime_ns))
+    with os.scandir(dst) as it:
+        for entry in it:
+            if entry.name not in src_names:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+
+def _json_load(path: Path):
+    """Parse JSON com orjson (C) quando disponível; stdlib como fallback."""
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _json_dump(data, path: Path):
+    """Escrita atômica: tmp + fsync + os.replace.
+
+    Truncar o arquivo in-place deixava um Bookmarks de zero bytes se o
+    processo morresse no meio; com rename atômico o leitor sempre vê a
+    versão antiga ou a nova completa, e pagamos um único fsync no final.
+    """
+    tmp = path.with_suffix('.tmp')
+    # orjson só indenta com 2 espaços; o Chromium aceita qualquer indentação.
+    if orjson is not None:
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
 class BrowserProfile:
     """Representa um perfil de navegador Chromium."""
     def __init__(self, name: str, user_data_path: Path, process_name: str):
@@ -43,23 +197,27 @@ class BrowserProfile:
         
     def is_running(self) -> bool:
         """Verifica se o processo do navegador está ativo."""
-        try:
-            subprocess.check_call(["pgrep", "-x", self.process_name], stdout=subprocess.DEVNULL)
-            return True
-        except subprocess.CalledProcessError:
-            return False
+        return self.process_name in _running_procs()
 
 class SyncManager:
     """Gerencia a sincronização entre dois perfis."""
     
-    def __init__(self, source: BrowserProfile, target: BrowserProfile):
+    def __init__(self, source: BrowserProfile, target: BrowserProfile, skip_safety: bool = False):
         self.source = source
         self.target = target
+        # main() já valida todos os navegadores de uma vez; o flag evita
+        # repetir o check por par.
+        self.skip_safety = skip_safety
         self._id_counter = 0
+        self._id_lock = threading.Lock()
+        # Base capturada uma vez: gerar um id vira só um incremento, sem
+        # gettimeofday nem alocação de datetime por bookmark.
+        self._id_base = time.time_ns() // 1000
 
     def _generate_id(self) -> str:
-        self._id_counter += 1
-        return str(int(datetime.now().timestamp() * 1000000) + self._id_counter)
+        with self._id_lock:
+            self._id_counter += 1
+            return str(self._id_base + self._id_counter)
 
     def check_safety(self):
         """Abort se algum navegador do par atual estiver rodando."""
@@ -78,11 +236,13 @@ class SyncManager:
             logger.info("   -> Skipping Session Sync for Arc (Proprietary Sidebar Structure).")
             return
 
-        if not self.source.sessions_dir.exists() or not self.target.sessions_dir.exists():
+        src_stat = _cached_stat(self.source.sessions_dir)
+        tgt_stat = _cached_stat(self.target.sessions_dir)
+        if src_stat is None or tgt_stat is None:
             return
 
-        src_mtime = self.source.sessions_dir.stat().st_mtime
-        tgt_mtime = self.target.sessions_dir.stat().st_mtime
+        src_mtime = src_stat.st_mtime
+        tgt_mtime = tgt_stat.st_mtime
         
         if abs(src_mtime - tgt_mtime) < 5:
             return
@@ -100,84 +260,144 @@ class SyncManager:
             s_path = winner.path / item
             d_path = loser.path / item
             if s_path.exists():
-                if d_path.exists():
+                if s_path.is_dir():
+                    # Cópia incremental: na prática a maioria dos arquivos de
+                    # sessão não mudou — rmtree+copytree reescrevia tudo.
+                    if d_path.exists() and not d_path.is_dir():
+                        d_path.unlink()
+                    # mtime do diretório muda mesmo sem conteúdo novo (o
+                    # navegador só tocou arquivos); se a impressão digital
+                    # bate, o espelhamento inteiro é um no-op.
+                    if d_path.is_dir() and _dir_fingerprint(s_path) == _dir_fingerprint(d_path):
+                        continue
+                    _rsync_dir(s_path, d_path)
+                else:
                     if d_path.is_dir(): shutil.rmtree(d_path)
-                    else: d_path.unlink()
-                if s_path.is_dir(): shutil.copytree(s_path, d_path)
-                else: shutil.copy2(s_path, d_path)
+                    shutil.copy2(s_path, d_path)
 
     def merge_history(self, source: BrowserProfile, target: BrowserProfile):
         label = f"{source.name} -> {target.name}"
         logger.info(f"clock: Syncing History ({label})...")
         
-        if not source.history_db.exists() or not target.history_db.exists(): return
+        if not _cached_exists(source.history_db) or not _cached_exists(target.history_db): return
 
-        temp_src = Path(f"/tmp/sync_{source.name}_hist.db")
-        shutil.copy2(source.history_db, temp_src)
-        
         try:
-            with sqlite3.connect(temp_src) as src_conn, sqlite3.connect(target.history_db) as dst_conn:
-                src_cur = src_conn.cursor()
+            # uri=True na conexão principal habilita URIs também no ATTACH.
+            # closing() garante que o lock EXCLUSIVE é liberado na saída.
+            with closing(sqlite3.connect(f"file:{quote(str(target.history_db))}", uri=True)) as dst_conn:
+                # Transação única: N fsyncs viram 1 (autocommit por linha é o gargalo).
+                dst_conn.isolation_level = None
+                dst_conn.execute("PRAGMA journal_mode=WAL")
+                dst_conn.execute("PRAGMA synchronous=NORMAL")
+                dst_conn.execute("PRAGMA temp_store=MEMORY")
+                dst_conn.execute("PRAGMA cache_size=-65536")    # 64MB de page cache
+                dst_conn.execute("PRAGMA mmap_size=268435456")  # 256MB mmap
+                # Exclusivo é seguro: check_safety garante navegadores fechados.
+                dst_conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+
+                # ATTACH deixa o merge inteiro dentro do motor do SQLite:
+                # zero round-trips por linha em Python. Lemos a origem direto
+                # como snapshot imutável — o check_safety garante que nenhum
+                # navegador está escrevendo, então não precisamos copiar o DB
+                # inteiro para /tmp.
+                dst_conn.execute("ATTACH DATABASE ? AS src",
+                                 (f"file:{quote(str(source.history_db))}?mode=ro&immutable=1",))
                 dst_cur = dst_conn.cursor()
+                try:
+                    dst_cur.execute("BEGIN")
+
+                    dst_cur.execute("""
+                        INSERT INTO urls (url, title, visit_count, typed_count, last_visit_time, hidden)
+                        SELECT s.url, s.title, s.visit_count, s.typed_count, s.last_visit_time, s.hidden
+                        FROM src.urls s LEFT JOIN urls d ON d.url = s.url
+                        WHERE d.id IS NULL
+                    """)
 
-                src_cur.execute("SELECT id, url, title, visit_count, typed_count, last_visit_time, hidden FROM urls")
-                url_map = {}
-                for row in src_cur.fetchall():
-                    src_id, url, title, v_count, t_count, last_visit, hidden = row
-                    dst_cur.execute("SELECT id FROM urls WHERE url = ?", (url,))
-                    match = dst_cur.fetchone()
-                    if match:
-                        tgt_id = match[0]
-                        dst_cur.execute("UPDATE urls SET last_visit_time = MAX(last_visit_time, ?) WHERE id = ?", (last_visit, tgt_id))
-                    else:
-                        dst_cur.execute("INSERT INTO urls (url, title, visit_count, typed_count, last_visit_time, hidden) VALUES (?, ?, ?, ?, ?, ?)", (url, title, v_count, t_count, last_visit, hidden))
-                        tgt_id = dst_cur.lastrowid
-                    url_map[src_id] = tgt_id
-
-                src_cur.execute("SELECT id, url, visit_time, from_visit, transition, segment_id, visit_duration FROM visits")
-                added = 0
-                for row in src_cur.fetchall():
-                    _, src_url_id, v_time, from_v, trans, seg_id, v_dur = row
-                    if src_url_id not in url_map: continue
-                    tgt_url_id = url_map[src_url_id]
-                    dst_cur.execute("SELECT id FROM visits WHERE url = ? AND visit_time = ?", (tgt_url_id, v_time))
-                    if dst_cur.fetchone(): continue
-                    dst_cur.execute("INSERT INTO visits (url, visit_time, from_visit, transition, segment_id, visit_duration) VALUES (?, ?, ?, ?, ?, ?)", (tgt_url_id, v_time, 0, trans, seg_id, v_dur))
-                    added += 1
-                dst_conn.commit()
+                    # UPDATE..FROM com a origem agregada uma vez: evita a
+                    # subquery correlacionada (re-executada por url) e só
+                    # toca linhas cujo timestamp realmente avança.
+                    dst_cur.execute("""
+                        UPDATE urls SET last_visit_time = s.lvt
+                        FROM (SELECT url, MAX(last_visit_time) AS lvt FROM src.urls GROUP BY url) AS s
+                        WHERE s.url = urls.url AND s.lvt > urls.last_visit_time
+                    """)
+
+                    # Em cargas grandes, derrubar os índices de visits antes do
+                    # insert evita N atualizações de B-tree por linha; recriar
+                    # no final é um único sort. Abaixo do limiar não compensa.
+                    src_visits = dst_cur.execute("SELECT COUNT(*) FROM src.visits").fetchone()[0]
+                    dropped_indexes = []
+                    if src_visits > 10000:
+                        dropped_indexes = dst_cur.execute(
+                            "SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name='visits' AND sql IS NOT NULL"
+                        ).fetchall()
+                        for name, _ in dropped_indexes:
+                            dst_cur.execute(f'DROP INDEX "{name}"')
+
+                    dst_cur.execute("""
+                        INSERT INTO visits (url, visit_time, from_visit, transition, segment_id, visit_duration)
+                        SELECT d.id, s.visit_time, 0, s.transition, s.segment_id, s.visit_duration
+                        FROM src.visits s
+                        JOIN src.urls su ON su.id = s.url
+                        JOIN urls d ON d.url = su.url
+                        LEFT JOIN visits v ON v.url = d.id AND v.visit_time = s.visit_time
+                        WHERE v.id IS NULL
+                    """)
+                    added = dst_cur.rowcount
+
+                    for _, ddl in dropped_indexes:
+                        dst_cur.execute(ddl)
+
+                    dst_cur.execute("COMMIT")
+                except Exception:
+                    dst_cur.execute("ROLLBACK")
+                    raise
+                finally:
+                    dst_conn.execute("DETACH DATABASE src")
                 logger.info(f"   -> {added} visits merged.")
         except Exception as e:
             logger.error(f"❌ SQL Error ({label}): {e}")
-        finally:
-            if temp_src.exists(): temp_src.unlink()
 
     def sync_bookmarks(self, source: BrowserProfile, target: BrowserProfile):
         label = f"{source.name} -> {target.name}"
         logger.info(f"🔖 Syncing Bookmarks ({label})...")
         
-        if not source.bookmarks_file.exists(): return
-        if not target.bookmarks_file.exists():
+        if not _cached_exists(source.bookmarks_file): return
+        if not _cached_exists(target.bookmarks_file):
             shutil.copy2(source.bookmarks_file, target.bookmarks_file)
+            _stat_cache.pop(str(target.bookmarks_file), None)
             return
 
         try:
-            with open(source.bookmarks_file, 'r', encoding='utf-8') as f: src_data = json.load(f)
-            with open(target.bookmarks_file, 'r', encoding='utf-8') as f: dst_data = json.load(f)
+            src_data = _json_load(source.bookmarks_file)
+            dst_data = _json_load(target.bookmarks_file)
             
             count = 0
-            def _recursive_sync(src_node, dst_parent):
-                nonlocal count
-                dst_map = {}
-                if 'children' in dst_parent:
-                    for child in dst_parent['children']:
+            now_us = str(time.time_ns() // 1000)  # date_added único para toda a passada
+            # Caminhada iterativa (BFS com deque) em vez de recursão: sem limite
+            # de profundidade e sem custo de frame/closure por pasta.
+            stack = deque()
+            stack.append((src_data.get('roots', {}).get('bookmark_bar', {}), dst_data.get('roots', {}).get('bookmark_bar', {})))
+            stack.append((src_data.get('roots', {}).get('other', {}), dst_data.get('roots', {}).get('other', {})))
+            # Índice filho->nó por pasta de destino, construído UMA vez por
+            # pasta (memoizado por id()); inserções atualizam o índice, então
+            # nunca re-escaneamos a lista de filhos.
+            folder_maps = {}
+            while stack:
+                src_node, dst_parent = stack.popleft()
+                dst_map = folder_maps.get(id(dst_parent))
+                if dst_map is None:
+                    dst_map = {}
+                    for child in dst_parent.get('children', ()):
                         key = child.get('url') if child.get('type') == 'url' else child.get('name')
                         if key: dst_map[key] = child
+                    folder_maps[id(dst_parent)] = dst_map
 
                 if 'children' in src_node:
                     for item in src_node['children']:
                         itype = item.get('type')
                         key = item.get('url') if itype == 'url' else item.get('name')
-                        
+
                         if itype == 'url':
                             if key not in dst_map:
                                 new_item = item.copy()
@@ -191,7 +411,7 @@ class SyncManager:
                             tgt_folder = dst_map.get(key)
                             if not tgt_folder:
                                 tgt_folder = {
-                                    "date_added": str(int(datetime.now().timestamp() * 1000000)),
+                                    "date_added": now_us,
                                     "id": self._generate_id(),
                                     "name": key,
                                     "type": "folder",
@@ -200,23 +420,35 @@ class SyncManager:
                                 if 'children' not in dst_parent: dst_parent['children'] = []
                                 dst_parent['children'].append(tgt_folder)
                                 dst_map[key] = tgt_folder
-                            _recursive_sync(item, tgt_folder)
-
-            _recursive_sync(src_data.get('roots', {}).get('bookmark_bar', {}), dst_data.get('roots', {}).get('bookmark_bar', {}))
-            _recursive_sync(src_data.get('roots', {}).get('other', {}), dst_data.get('roots', {}).get('other', {}))
+                            stack.append((item, tgt_folder))
             
-            with open(target.bookmarks_file, 'w', encoding='utf-8') as f: json.dump(dst_data, f, indent=4)
+            # Solta a árvore de origem antes de serializar: o pico de RSS
+            # passa a ser max(origem, destino) em vez da soma — os itens
+            # copiados são dicts novos, só strings são compartilhadas.
+            del stack, folder_maps
+            src_data = None
+
+            _json_dump(dst_data, target.bookmarks_file)
             logger.info(f"   -> {count} bookmarks synced.")
         except Exception as e:
             logger.error(f"❌ JSON Error ({label}): {e}")
 
     def run_bidirectional(self):
-        self.check_safety()
+        _invalidate_stat_cache()
+        if not self.skip_safety:
+            self.check_safety()
         self.sync_sessions_smart()
-        self.merge_history(self.source, self.target)
-        self.merge_history(self.target, self.source)
-        self.sync_bookmarks(self.source, self.target)
-        self.sync_bookmarks(self.target, self.source)
+        # Histórico e bookmarks da MESMA direção tocam arquivos diferentes e
+        # são I/O-bound (fsync do SQLite), então rodam em paralelo. Direções
+        # opostas não: cada uma lê o arquivo que a outra escreve.
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            for src, tgt in ((self.source, self.target), (self.target, self.source)):
+                futures = [
+                    ex.submit(self.merge_history, src, tgt),
+                    ex.submit(self.sync_bookmarks, src, tgt),
+                ]
+                for f in futures:
+                    f.result()
 
 def main():
     home = Path.home()
@@ -236,11 +468,12 @@ def main():
             sys.exit(0)
 
     # 3. Execução em Cadeia (Arc como Hub)
+    # A verificação global acima já provou que está tudo fechado.
     if arc.path.exists():
-        if dia.path.exists():      SyncManager(arc, dia).run_bidirectional()
-        if vivaldi.path.exists():  SyncManager(arc, vivaldi).run_bidirectional()
-        if edge.path.exists():     SyncManager(arc, edge).run_bidirectional()
-        if brave.path.exists():    SyncManager(arc, brave).run_bidirectional()
+        if dia.path.exists():      SyncManager(arc, dia, skip_safety=True).run_bidirectional()
+        if vivaldi.path.exists():  SyncManager(arc, vivaldi, skip_safety=True).run_bidirectional()
+        if edge.path.exists():     SyncManager(arc, edge, skip_safety=True).run_bidirectional()
+        if brave.path.exists():    SyncManager(arc, brave, skip_safety=True).run_bidirectional()
     else:
         logger.error("❌ Arc Profile (Hub) not found. Cannot sync.")
 